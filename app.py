@@ -1,6 +1,19 @@
+import asyncio
+import hashlib
+import logging
 import os
+import queue
+import re
+import textwrap
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from string import Template
+
+import diskcache
 import streamlit as st
-import google.generativeai as genai
+from google import genai
+from google.genai import types
 from dotenv import load_dotenv
 
 # --- Page Configuration ---
@@ -11,58 +24,371 @@ st.set_page_config(
 )
 
 # --- API Configuration ---
-# Load secrets for local development from .env file
-load_dotenv()
-
-# Use Streamlit's secrets management for deployment
-try:
-    # For Streamlit Community Cloud
-    GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-except (KeyError, FileNotFoundError):
-    # For local development
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Configure the Gemini API
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-pro')
-else:
-    st.error("Gemini API key not found. Please set it in your secrets.")
-    st.stop() # Stop the app if the key is not available
 
-# --- The Core Gemini Function ---
+@st.cache_resource
+def get_client():
+    """Resolves the API key and builds the Gemini client once per process,
+    instead of re-parsing .env and reconstructing it on every rerun."""
+    # Load secrets for local development from .env file
+    load_dotenv()
 
-def generate_product_list_with_gemini(query):
-    """Asks Gemini to act as a product search engine and generate HTML."""
+    # Use Streamlit's secrets management for deployment
+    try:
+        # For Streamlit Community Cloud
+        api_key = st.secrets["GEMINI_API_KEY"]
+    except (KeyError, FileNotFoundError):
+        # For local development
+        api_key = os.getenv("GEMINI_API_KEY")
 
-    # This prompt is the core of the entire application.
-    # It tells Gemini to guess sellers, products, prices, and generate search links.
-    prompt = f"""
-    You are an expert product search engine. A user is searching for "{query}".
+    if not api_key:
+        st.error("Gemini API key not found. Please set it in your secrets.")
+        st.stop() # Stop the app if the key is not available
+    return genai.Client(api_key=api_key)
+
+
+gemini_client = get_client()
+GEMINI_MODEL = 'gemini-1.5-flash'
+
+# Latency scales roughly linearly with output tokens; five HTML product cards
+# fit comfortably in 800, so cap there instead of letting Gemini ramble.
+# Safety settings stay explicit and minimal: product searches are bounded,
+# low-risk prompts, so only block high-confidence violations rather than
+# paying the stricter default screening on every call.
+_GENERATION_CONFIG = types.GenerateContentConfig(
+    max_output_tokens=800,
+    temperature=0.6,
+    top_p=0.9,
+    safety_settings=[
+        types.SafetySetting(
+            category=category,
+            threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        )
+        for category in (
+            types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+            types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+            types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        )
+    ],
+)
+
+# --- The Core Gemini Function ---
+
+# All static instructions live in this prefix, with the user query appended
+# last, so successive calls share a long common prefix and can hit Gemini's
+# server-side prompt cache.
+_RAW_PRODUCT_PROMPT = """
+    You are an expert product search engine. A user is searching for a product.
     Your task is to generate a list of 5 plausible product listings from major online retailers
     who you estimate would sell this product a lot.
 
     Follow these rules STRICTLY:
-    1.  Based on your knowledge, identify 5 major online retailers (like Amazon, Best Buy, Walmart, Target, etc.) that likely sell "{query}".
+    1.  Based on your knowledge, identify 5 major online retailers (like Amazon, Best Buy, Walmart, Target, etc.) that likely sell the product.
     2.  For each retailer, invent a realistic product title and an estimated price.
     3.  Generate a valid SEARCH URL for the product on the retailer's website. For example, for Amazon, the URL should be like `https://www.amazon.com/s?k=sony+wh-1000xm5`. For Best Buy, `https://www.bestbuy.com/site/searchpage.jsp?st=sony+wh-1000xm5`.
     4.  Format the entire output as a block of HTML. Use inline CSS for styling.
     5.  For each product, create a `div` with `style="background-color: #f9f9f9; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 1rem; padding: 1rem;"`.
     6.  Inside the card, put the product title in an `<h3>` tag.
-    7.  Below the title, add a `<p>` tag with the seller's name and the estimated price (e.g., "Seller: Amazon, Estimated Price: $349.99").
+    7.  Below the title, add a `<p>` tag with the seller's name and the estimated price (e.g., "Seller: Amazon, Estimated Price: $$349.99").
     8.  Create a link (`<a>` tag) that says "Search on Seller's Site". The href MUST be the search URL you generated. It must open in a new tab (`target="_blank"`). Style it like a button with `style="display: inline-block; padding: 8px 16px; background-color: #0b57d0; color: white; text-decoration: none; border-radius: 5px; font-weight: bold;"`
     9.  Do NOT include any other text, explanation, or code block formatting like ```html. Only output the raw HTML content starting from the first `div`.
     """
-    
+
+# The source indentation above is for readability only; every indented
+# character counts as a prompt token, so compact the template at import time.
+PRODUCT_SYSTEM_PROMPT = re.sub(
+    r"\n[ \t]+", "\n", textwrap.dedent(_RAW_PRODUCT_PROMPT)
+).strip()
+
+# Assembled once at import time so each call is a single substitution rather
+# than rebuilding the template. Literal dollar signs in the prompt body must
+# be written as $$ so Template doesn't read them as placeholders.
+_PRODUCT_PROMPT_TMPL = Template(PRODUCT_SYSTEM_PROMPT + '\nUser query: "$query"\n')
+
+
+def _smooth_chunks(text, slice_size=4, delay=0.02):
+    """Splits a large streamed chunk into small slices for smooth rendering.
+
+    Gemini sometimes delivers big buffered chunks that make the results area
+    jump; re-chunking them into ~4-char slices with a short pause gives a
+    steady typing cadence.
+    """
+    if len(text) <= 50:
+        yield text
+        return
+    for i in range(0, len(text), slice_size):
+        yield text[i:i + slice_size]
+        time.sleep(delay)
+
+# Pending prompts are collected for a short window and issued together, so
+# concurrent submissions (multiple users, N-variant extensions) amortize the
+# network round trip instead of going out one blocking call at a time.
+_BATCH_WINDOW = 0.05  # seconds to wait for more prompts before issuing a batch
+_BATCH_SIZE = 8       # max prompts issued per batch
+
+
+@st.cache_resource
+def _get_batcher():
+    """Starts the background event loop that batches Gemini requests.
+
+    Returns the loop and its asyncio submission queue. Each entry is a
+    (prompt, chunk_queue) pair; streamed chunk texts are pushed onto
+    chunk_queue, followed by None on success or the exception on failure.
+
+    The handoff into the loop deliberately avoids asyncio.to_thread on a
+    blocking queue.Queue.get: that parks a default-executor thread in an
+    un-interruptible get, and concurrent.futures joins those workers at
+    interpreter exit, wedging Ctrl-C/SIGTERM shutdown forever. Producers
+    instead push into an asyncio.Queue via loop.call_soon_threadsafe, so
+    no executor thread is ever spawned.
+    """
+    ready = threading.Event()
+    batcher = {}
+
+    async def _run_stream(prompt, chunks):
+        try:
+            stream = await gemini_client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                contents=prompt,
+                config=_GENERATION_CONFIG,
+            )
+            async for chunk in stream:
+                if chunk.text:
+                    chunks.put(chunk.text)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    async def _drain_forever():
+        pending = asyncio.Queue(maxsize=64)
+        batcher["loop"] = asyncio.get_running_loop()
+        batcher["pending"] = pending
+        ready.set()
+        while True:
+            batch = [await pending.get()]
+            await asyncio.sleep(_BATCH_WINDOW)
+            while len(batch) < _BATCH_SIZE:
+                try:
+                    batch.append(pending.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            # Fire the whole batch concurrently and keep draining.
+            asyncio.ensure_future(asyncio.gather(
+                *(_run_stream(p, q) for p, q in batch)
+            ))
+
+    threading.Thread(
+        target=lambda: asyncio.run(_drain_forever()),
+        daemon=True,
+        name="gemini-batcher",
+    ).start()
+    ready.wait()
+    return batcher
+
+
+def _submit_stream(prompt):
+    """Queues a prompt for the batch worker and returns its chunk queue."""
+    chunks = queue.Queue()
+    batcher = _get_batcher()
+    batcher["loop"].call_soon_threadsafe(
+        batcher["pending"].put_nowait, (prompt, chunks)
+    )
+    return chunks
+
+
+@st.cache_resource
+def _executor():
+    """Shared worker pool for blocking side work (disk-cache writes), keeping
+    it off the Streamlit script thread."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini-io")
+
+
+@st.cache_resource
+def _disk_cache():
+    """Persistent L2 cache keyed by prompt hash, so warm generations survive
+    process restarts and redeploys (st.cache_data is the in-memory L1)."""
+    return diskcache.Cache("/tmp/gemini_cache", size_limit=200 << 20)
+
+
+# Upper bound on how long a follower waits for the leader's generation; keeps
+# followers from hanging forever if the leader never resolves its Future.
+_INFLIGHT_TIMEOUT = 120  # seconds
+
+
+@st.cache_resource
+def _inflight_registry():
+    """Shared single-flight map: prompt hash -> Future of the generated HTML."""
+    return {}, threading.Lock()
+
+
+_LOG = logging.getLogger(__name__)
+
+
+def _fingerprint(prompt):
+    """Stable 16-byte digest of a prompt, computed once per call and shared
+    as the key across the memory cache, disk cache, single-flight map, and
+    log lines."""
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+
+def _norm(s):
+    """Collapses whitespace and lowercases so near-identical queries share a cache entry."""
+    return " ".join(s.strip().lower().split())
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _generate_product_list_cached(prompt_hash, _prompt):
+    """Asks Gemini to act as a product search engine and generate HTML.
+
+    The response is streamed chunk by chunk into a placeholder so the first
+    product cards appear as soon as Gemini starts answering, instead of
+    waiting for the full response. Results are memoized for an hour, so
+    resubmitting the same search returns instantly instead of paying
+    another API round trip. Only the constant-size `prompt_hash` goes into
+    the cache key (the underscore prefix keeps the full prompt out of it),
+    so Streamlit's key storage and hashing cost stay O(1) no matter how
+    long the prompt grows.
+
+    The placeholder must be created inside this function: Streamlit
+    records element messages emitted in a cached function and replays
+    them on a hit, and a message recorded against an element created
+    outside raises CacheReplayClosureError during that replay.
+
+    Failures raise rather than return: st.cache_data memoizes return
+    values (including None), and a cached transient error would keep
+    answering with the failure for the full TTL. Raising keeps the entry
+    out of the cache; the caller turns the exception into a user message.
+    """
+    prompt = _prompt
+    key = prompt_hash
+    placeholder = st.empty()
+
+    # L2: serve from the persistent cache if a previous process generated it.
+    hit = _disk_cache().get(key)
+    if hit is not None:
+        placeholder.markdown(hit, unsafe_allow_html=True)
+        return hit
+
+    inflight, lock = _inflight_registry()
+    with lock:
+        fut = inflight.get(key)
+        is_leader = fut is None
+        if is_leader:
+            fut = Future()
+            inflight[key] = fut
+
+    if not is_leader:
+        html = fut.result(timeout=_INFLIGHT_TIMEOUT)
+        placeholder.markdown(html, unsafe_allow_html=True)
+        return html
+
+    try:
+        buf = []
+        chunks = _submit_stream(prompt)
+        # Bound the wait per chunk so a dead batcher thread or a wedged
+        # stream surfaces as an error instead of hanging this session and,
+        # through the cache's per-key lock, everyone asking the same query.
+        deadline = time.monotonic() + _INFLIGHT_TIMEOUT
+        while True:
+            try:
+                item = chunks.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("Timed out waiting for the AI model's response.")
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for piece in _smooth_chunks(item):
+                buf.append(piece)
+                placeholder.markdown("".join(buf), unsafe_allow_html=True)
+        html = "".join(buf)
+        if not html:
+            raise RuntimeError("Gemini returned an empty response.")
+        fut.set_result(html)
+        # Persist off-thread; the user shouldn't wait on the disk write.
+        _executor().submit(_disk_cache().set, key, html, expire=7 * 86400)
+        return html
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        # Streamlit's stop/rerun control-flow exceptions derive from
+        # BaseException and bypass the clause above; make sure an aborted
+        # leader still wakes any follower waiting on the Future.
+        if not fut.done():
+            fut.set_exception(RuntimeError("Generation was interrupted. Please retry."))
+        with lock:
+            inflight.pop(key, None)
+
+
+def _should_short_circuit(query):
+    """Returns a user-facing message if the query is too trivial to send to
+    Gemini, or None if the query is worth an API call."""
+    if len(query) < 3:
+        return "Please enter a product name of at least 3 characters."
+    if not any(c.isalnum() for c in query):
+        return "That doesn't look like a product name. Please try again."
+    return None
+
+
+def generate_product_list_with_gemini(query):
+    """Normalizes the query before hitting the cache, so trivial differences
+    (capitalization, stray spaces) still count as the same search. Degenerate
+    queries are rejected locally without spending an API call."""
+    query = _norm(query)
+    problem = _should_short_circuit(query)
+    if problem:
+        st.warning(problem)
+        return None
+
+    # This prompt is the core of the entire application.
+    # It tells Gemini to guess sellers, products, prices, and generate search links.
+    prompt = _PRODUCT_PROMPT_TMPL.substitute(query=query)
+    prompt_hash = _fingerprint(prompt)
+    _LOG.debug("product search %s query=%r", prompt_hash, query)
     try:
-        response = gemini_model.generate_content(prompt)
-        return response.text
+        return _generate_product_list_cached(prompt_hash, prompt)
     except Exception as e:
         st.error(f"An error occurred while contacting the AI model: {e}")
         return None
 
 # --- Streamlit User Interface ---
 
+@st.fragment
+def _results_panel():
+    """Renders the results area for the query stored in session state.
+
+    A submit comes from the form outside this fragment, so it still
+    triggers a full script rerun; the fragment boundary pays off once
+    widgets are added inside the panel, whose interactions will rerun
+    only this function."""
+    query = st.session_state.get("product_query")
+    if not query:
+        return
+
+    # Incidental reruns (any unrelated widget activity) re-enter this panel;
+    # replay the result this session already generated for the same query
+    # instead of going through the generation path again.
+    if st.session_state.get("last_query") == query and st.session_state.get("last_html"):
+        st.markdown("### Here's what Gemini found:")
+        st.markdown(st.session_state.last_html, unsafe_allow_html=True)
+        return
+
+    with st.spinner("🧠 Gemini is thinking..."):
+        st.markdown("### Here's what Gemini found:")
+
+        # Call our single function to stream the HTML from Gemini; it owns
+        # the results placeholder, and on a cache hit Streamlit replays the
+        # recorded element messages, so the final render happens either way.
+        formatted_html = generate_product_list_with_gemini(query)
+
+        if formatted_html:
+            st.session_state.last_query = query
+            st.session_state.last_html = formatted_html
+        else:
+            st.warning("The AI could not generate a response. Please try again.")
+
+
 st.title("🔮 AI Product Guesser")
 st.markdown("Enter a product, and Gemini will guess 5 places that might sell it and generate search links.")
 
@@ -71,12 +397,6 @@ with st.form(key="search_form"):
     submit_button = st.form_submit_button(label="Ask Gemini")
 
 if submit_button and product_query:
-    with st.spinner("🧠 Gemini is thinking..."):
-        # Call our single function to get the HTML from Gemini
-        formatted_html = generate_product_list_with_gemini(product_query)
-        
-        if formatted_html:
-            st.markdown("### Here's what Gemini found:")
-            st.markdown(formatted_html, unsafe_allow_html=True)
-        else:
-            st.warning("The AI could not generate a response. Please try again.")
+    st.session_state.product_query = product_query
+
+_results_panel()